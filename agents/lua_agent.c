@@ -328,6 +328,23 @@ void update_score(struct Context *ctx, uint32_t agent_id, int32_t score)
     }
 }
 
+void update_entity(struct Context *ctx,
+                   uint32_t agent_id,
+                   int32_t hp,
+                   float ship_x,
+                   float ship_y,
+                   float ship_heading,
+                   int32_t shot_lifetime,
+                   float shot_x,
+                   float shot_y,
+                   float shot_heading,
+                   int32_t score)
+{
+    update_ship(ctx, agent_id, hp, ship_x, ship_y, ship_heading);
+    update_shot(ctx, agent_id, shot_lifetime, shot_x, shot_y, shot_heading);
+    update_score(ctx, agent_id, score);
+}
+
 uint32_t make_action(struct Context *ctx, uint32_t agent_id, uint32_t tick)
 {
     if (!ctx || ctx->trapped)
@@ -47,16 +47,30 @@
  * of these functions and their parameter types.
  *  - ::init_agent()            Create a new per-round \c Context.
  *  - ::set_config_parameter()  Receive immutable engine configuration.
- *  - ::clear_world_state()     Begin a new per-tick observation frame.
+ *  - ::clear_world_state()     Begin a new observation frame.
  *  - ::update_ship()           Receive one ship state (per \c agent_id).
  *  - ::update_shot()           Receive one shot state (per \c agent_id).
  *  - ::update_score()          Receive one score value (per \c agent_id).
  *  - ::make_action()           Decide actions for one controlled \c agent_id.
  *  - ::free_context()          Destroy \c Context and release resources.
  *
+ * **Optional exported functions**
+ *
+ * An agent WASM module may additionally export:
+ *  - ::update_entity()         Receive ship, shot, and score of one
+ *                              \c agent_id in a single call.
+ *
+ * If ::update_entity() is exported, the host uses it instead of calling
+ * ::update_ship(), ::update_shot(), and ::update_score() individually. This
+ * saves two host-to-WASM transitions per \c agent_id and decision tick.
+ *
  * **Typical call pattern**
  *
- * The host drives an agent instance in three phases:
+ * The host drives an agent instance in three phases. Agents are only queried
+ * on *decision ticks*, i.e., every K-th engine tick, where K is the host's
+ * agent decision period (by default 1, such that every tick is a decision
+ * tick). On the ticks in between, the host makes no agent calls at all and
+ * applies the actions returned on the last decision tick again.
  *
  * \b 1) Initialization (once per round)
  *  - The host creates a new agent instance by calling ::init_agent() and keeps
@@ -65,17 +79,19 @@
  *    ::set_config_parameter() exactly once for each relevant ::ConfigParameter.
  *    Agents should cache these values in \c Context for later planning.
  *
- * \b 2) Per-tick update and decision (repeated for each tick)
- *  - At the beginning of each tick, the host starts a fresh observation frame
- *    by calling ::clear_world_state(). (If fuel metering is enabled, the host
- *    may also reset the execution budget for this tick before making further
- *    calls.)
+ * \b 2) Update and decision (repeated for each decision tick)
+ *  - At the beginning of each decision tick, the host starts a fresh
+ *    observation frame by calling ::clear_world_state(). (If fuel metering is
+ *    enabled, the host may also reset the execution budget for this decision
+ *    tick before making further calls.)
  *  - The host then streams a snapshot of the current world state to the agent
  *    by calling:
  *      - ::update_ship() for ships (identified by \c agent_id),
  *      - ::update_shot() for shots (identified by the owning \c agent_id; a
  *        \c lifetime of 0 indicates an inactive shot), and
- *      - ::update_score() for scores (per \c agent_id).
+ *      - ::update_score() for scores (per \c agent_id),
+ *
+ *    or, if exported, ::update_entity() once per \c agent_id instead.
  *
  *    In a typical setup, the host broadcasts the same complete snapshot to
  *    every agent module, so each agent can observe all teams, not only itself.
@@ -92,8 +108,10 @@
  *    The host will not call ::make_action() for dead ships.
  *
  *  - Once actions for all teams have been collected, the host advances the
- *    simulation by one (or more) engine ticks (e.g., \c engine.tick()) and then
- *    repeats the process for the next tick.
+ *    simulation by K engine ticks (e.g., \c engine.tick()), applying the same
+ *    actions on each of them, and then repeats the process for the next
+ *    decision tick. The \c tick passed to ::make_action() is the current
+ *    engine tick number, so it advances in steps of K between decisions.
  *
  * \b 3) Shutdown (once per round)
  *  - When the round ends, the host calls ::free_context().
@@ -101,21 +119,22 @@
  * **Discovering the team's agent IDs**
  *
  * The agent does not receive an explicit list of the \c agent_id values it
- * controls. Instead, the host calls ::make_action() once per tick for each
- * \c agent_id that belongs to the team controlled by this WASM module. Agents
- * that need a stable roster must infer and maintain the set of controlled
- * \c agent_id values from these calls (e.g., by recording each \c agent_id
- * observed in ::make_action()).
+ * controls. Instead, the host calls ::make_action() once per decision tick for
+ * each \c agent_id that belongs to the team controlled by this WASM module.
+ * Agents that need a stable roster must infer and maintain the set of
+ * controlled \c agent_id values from these calls (e.g., by recording each
+ * \c agent_id observed in ::make_action()).
  *
  * **Fuel metering and unresponsive agents**
  *
- * All agent interactions within a tick (including calls to
+ * All agent interactions within a decision tick (including calls to
  * ::clear_world_state(), ::update_ship(), ::update_shot(), ::update_score(),
- * and ::make_action()) are metered in units of wasmtime fuel. Before each tick,
- * the host refuels the agent instance to a fixed budget; the agent must not
- * exceed this budget over the tick. If the fuel is exhausted during a tick, the
- * agent becomes unresponsive and the host will stop calling ::make_action()
- * for that agent for the remainder of the round.
+ * ::update_entity(), and ::make_action()) are metered in units of wasmtime
+ * fuel. Before each decision tick, the host refuels the agent instance to a
+ * fixed budget; the agent must not exceed this budget over the decision tick.
+ * If the fuel is exhausted during a decision tick, the agent becomes
+ * unresponsive and the host will stop calling ::make_action() for that agent
+ * for the remainder of the round.
  *
  * **Coordinate conventions**
  *
@@ -296,9 +315,9 @@ void set_config_parameter(struct Context *ctx,
                           float value);
 
 /**
- * \brief Clear all observations for the next tick.
+ * \brief Clear all observations for the next decision tick.
  *
- * Called at the beginning of each tick, before any \c update_* calls.
+ * Called at the beginning of each decision tick, before any \c update_* calls.
  *
  * \param ctx Context pointer returned by ::init_agent().
  */
@@ -307,7 +326,7 @@ void clear_world_state(struct Context *ctx);
 /**
  * \brief Provide the current state of a ship.
  *
- * Called once per ship per tick to stream the full world state.
+ * Called once per ship per decision tick to stream the full world state.
  *
  * \param ctx Context pointer returned by ::init_agent().
  * \param agent_id 32-bit ID of the ship (and its controlling agent).
@@ -326,7 +345,8 @@ void update_ship(struct Context *ctx,
 /**
  * \brief Provide the current state of a shot.
  *
- * Called once per (active) shot per tick to stream the full world state.
+ * Called once per (active) shot per decision tick to stream the full world
+ * state.
  *
  * Whether the host calls this function for dead shots (i.e., \c lifetime == 0)
  * is engine-defined.
@@ -349,7 +369,7 @@ void update_shot(struct Context *ctx,
 /**
  * \brief Provide the current score for one agent.
  *
- * Called once per agent per tick to stream the scores.
+ * Called once per agent per decision tick to stream the scores.
  *
  * \param ctx Context pointer returned by ::init_agent().
  * \param agent_id 32-bit agent ID.
@@ -357,10 +377,48 @@ void update_shot(struct Context *ctx,
  */
 void update_score(struct Context *ctx, uint32_t agent_id, int32_t score);
 
+/**
+ * \brief Provide the current ship state, shot state, and score for one agent.
+ *
+ * Optional. If exported, the host calls this function once per agent per
+ * decision tick instead of ::update_ship(), ::update_shot(), and
+ * ::update_score(). It must behave like calling these three functions with the
+ * respective arguments.
+ *
+ * \param ctx Context pointer returned by ::init_agent().
+ * \param agent_id 32-bit agent ID (of the ship and its shot).
+ * \param hp Ship "health": \c 1 if alive, \c 0 if not alive.
+ * \param ship_x Ship x-position on the unit torus.
+ * \param ship_y Ship y-position on the unit torus.
+ * \param ship_heading Ship heading in degrees.
+ * \param shot_lifetime Remaining shot lifetime in ticks. A value of \c 0
+ *        indicates that the shot is not active.
+ * \param shot_x Shot x-position on the unit torus.
+ * \param shot_y Shot y-position on the unit torus.
+ * \param shot_heading Shot heading in degrees.
+ * \param score Current score.
+ *
+ * \see update_ship
+ * \see update_shot
+ * \see update_score
+ */
+void update_entity(struct Context *ctx,
+                   uint32_t agent_id,
+                   int32_t hp,
+                   float ship_x,
+                   float ship_y,
+                   float ship_heading,
+                   int32_t shot_lifetime,
+                   float shot_x,
+                   float shot_y,
+                   float shot_heading,
+                   int32_t score);
+
 /**
  * \brief Compute the action for one controlled team member.
  *
- * Called once per tick for each \c agent_id in the team.
+ * Called once per decision tick for each \c agent_id in the team. The
+ * returned actions are held until the next decision tick.
  *
  * \param ctx Context pointer returned by ::init_agent().
  * \param agent_id 32-bit ID of the ship/agent to act for.
@@ -1,4 +1,3 @@
-import functools
 import logging
 
 from .wasmmodule import WASMModule
@@ -6,22 +5,6 @@ from .wasmmodule import WASMModule
 logger = logging.getLogger(__name__)
 
 
-def fuel_guard(fn):
-    @functools.wraps(fn)
-    def wrapper(self, *args, **kwargs):
-        if self._trapped:
-            return None
-
-        try:
-            return fn(self, *args, **kwargs)
-        except Exception as e:
-            logger.info("Filthy agent misbehaved and is now trapped: %s", e)
-            self._trapped = True
-            return None
-
-    return wrapper
-
-
 class Agent:
     def __init__(
         self,
@@ -36,6 +19,10 @@ class Agent:
     ):
         self._module = WASMModule(wasm, store=store, wasi=True)
 
+        # update_entity is an optional export; fall back to the individual
+        # update_* calls for agents that don't provide it
+        self._has_update_entity = hasattr(self._module, "update_entity")
+
         self._trapped = False
         self._fuel_limited = init_fuel_level is not None
         try:
@@ -72,26 +59,81 @@ class Agent:
     def trapped(self):
         return self._trapped
 
-    @fuel_guard
+    def _trap(self, e):
+        logger.info("Filthy agent misbehaved and is now trapped: %s", e)
+        self._trapped = True
+
+    # the methods below are called for every agent and tick, so the trap check
+    # is inlined rather than going through a wrapper
+
     def clear_world_state(self):
-        self._module.clear_world_state(self._ctx)
+        if self._trapped:
+            return
+
+        try:
+            self._module.clear_world_state(self._ctx)
+        except Exception as e:
+            self._trap(e)
+
+    # the single-entity updates are kept for callers that stream the state
+    # themselves; the game itself uses update_entity
 
-    @fuel_guard
     def update_ship(self, agent_id, *, is_alive, pose):
-        self._module.update_ship(
-            self._ctx, agent_id, 1 if is_alive else 0, pose.x, pose.y, pose.heading
-        )
+        if self._trapped:
+            return
+
+        try:
+            self._module.update_ship(
+                self._ctx, agent_id, 1 if is_alive else 0, pose.x, pose.y, pose.heading
+            )
+        except Exception as e:
+            self._trap(e)
 
-    @fuel_guard
     def update_shot(self, agent_id, *, lifetime, pose):
-        self._module.update_shot(
-            self._ctx, agent_id, lifetime, pose.x, pose.y, pose.heading
-        )
+        if self._trapped:
+            return
+
+        try:
+            self._module.update_shot(
+                self._ctx, agent_id, lifetime, pose.x, pose.y, pose.heading
+            )
+        except Exception as e:
+            self._trap(e)
 
-    @fuel_guard
     def update_score(self, agent_id, score):
-        self._module.update_score(self._ctx, agent_id, score)
+        if self._trapped:
+            return
+
+        try:
+            self._module.update_score(self._ctx, agent_id, score)
+        except Exception as e:
+            self._trap(e)
+
+    def update_entity(
+        self, agent_id, *, is_alive, ship_pose, lifetime, shot_pose, score
+    ):
+        if self._trapped:
+            return
+
+        hp = 1 if is_alive else 0
+        try:
+            if self._has_update_entity:
+                self._module.update_entity(
+                    self._ctx, agent_id, hp, *ship_pose, lifetime, *shot_pose, score
+                )
+            else:
+                self._module.update_ship(self._ctx, agent_id, hp, *ship_pose)
+                self._module.update_shot(self._ctx, agent_id, lifetime, *shot_pose)
+                self._module.update_score(self._ctx, agent_id, score)
+        except Exception as e:
+            self._trap(e)
 
-    @fuel_guard
     def make_action(self, agent_id, ticks):
-        return self._module.make_action(self._ctx, agent_id, ticks)
+        if self._trapped:
+            return None
+
+        try:
+            return self._module.make_action(self._ctx, agent_id, ticks)
+        except Exception as e:
+            self._trap(e)
+            return None
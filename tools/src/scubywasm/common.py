@@ -1,4 +1,7 @@
 import dataclasses
+from typing import NamedTuple
+
+import orjson
 
 
 @dataclasses.dataclass(frozen=True)
@@ -10,8 +13,17 @@ class Config:
     shot_lifetime: int
 
 
-@dataclasses.dataclass(frozen=True)
-class Pose:
+class Pose(NamedTuple):
     x: float
     y: float
     heading: float
+
+
+def serialize_log(log):
+    # agent IDs are used as (integer) keys, hence OPT_NON_STR_KEYS
+    return orjson.dumps(
+        log,
+        option=orjson.OPT_APPEND_NEWLINE
+        | orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_SERIALIZE_NUMPY,
+    )
@@ -1,82 +1,217 @@
 import argparse
-import json
+import functools
 import math
 from pathlib import Path
 
+import numpy as np
+import orjson
 import pygame
 
 
-def draw_ship(surf, color, x, y, r, heading):
+def wrapped_centers(surf, x, y, r):
     w, h = surf.get_size()
-    x0 = int(x * w)
-    y0 = int(y * h)
+    x0 = (x * w).astype(np.int32)
+    y0 = (y * h).astype(np.int32)
+
+    # only entities within r of an edge have visible torus copies; all others
+    # are drawn once at their center
+    edge = (x0 <= r) | (x0 >= w - r) | (y0 <= r) | (y0 >= h - r)
+    if not edge.any():
+        return np.arange(len(x0)), x0, y0
+
+    e = np.flatnonzero(edge)
+
+    # all 3x3 torus copies per edge entity, shape (E, 3, 3)
+    cx = x0[e, None, None] + np.array([-w, 0, w], dtype=np.int32)[None, :, None]
+    cy = y0[e, None, None] + np.array([-h, 0, h], dtype=np.int32)[None, None, :]
+    cx, cy = np.broadcast_arrays(cx, cy)
+
+    visible = (cx >= -r) & (cx <= w + r) & (cy >= -r) & (cy <= h + r)
+    k = np.concatenate((np.flatnonzero(~edge), e[np.nonzero(visible)[0]]))
+    cx = np.concatenate((x0[~edge], cx[visible]))
+    cy = np.concatenate((y0[~edge], cy[visible]))
+
+    # keep the drawing order by entity
+    order = np.argsort(k, kind="stable")
+
+    return k[order], cx[order], cy[order]
+
+
+# tip and rear corners of a ship with heading 90 deg, relative to its radius
+_ANG120 = 2.0 * math.pi / 3.0
+_SHIP_TEMPLATE = 0.9 * np.array(
+    [[math.cos(a), math.sin(a)] for a in (0.0, _ANG120, -_ANG120)]
+)
+
+
+def render_ship(color, r, heading):
+    # sprite of size (2r + 1, 2r + 1) with the ship centered at (r, r)
+    surf = pygame.Surface((2 * r + 1, 2 * r + 1), pygame.SRCALPHA)
 
     theta = math.radians(90.0 - heading)
-    ang120 = 2.0 * math.pi / 3.0
+    c, s = math.cos(theta), math.sin(theta)
+    R = np.array([[c, -s], [s, c]])
 
-    rt = 0.9 * r
+    corners = np.rint(r * _SHIP_TEMPLATE @ R.T).astype(np.int32)
+    (Ax, Ay), (Bx, By), (Cx, Cy) = corners.tolist()
 
-    for dx in (-w, 0, w):
-        for dy in (-h, 0, h):
-            cx = x0 + dx
-            cy = y0 + dy
-            if -r <= cx <= w + r and -r <= cy <= h + r:
-                P = cx, h - cy
+    P = r, r
+    A = r + Ax, r - Ay
+    B = r + Bx, r - By
+    C = r + Cx, r - Cy
 
-                Ax = cx + rt * math.cos(theta)
-                Ay = cy + rt * math.sin(theta)
-                Bx = cx + rt * math.cos(theta + ang120)
-                By = cy + rt * math.sin(theta + ang120)
-                Cx = cx + rt * math.cos(theta - ang120)
-                Cy = cy + rt * math.sin(theta - ang120)
+    pygame.draw.polygon(surf, color, [A, B, P])
+    pygame.draw.polygon(surf, color, [A, P, C])
+    pygame.draw.circle(surf, color, P, r, width=2)
 
-                A = int(round(Ax)), h - int(round(Ay))
-                B = int(round(Bx)), h - int(round(By))
-                C = int(round(Cx)), h - int(round(Cy))
+    return surf
 
-                pygame.draw.polygon(surf, color, [A, B, P])
-                pygame.draw.polygon(surf, color, [A, P, C])
-                pygame.draw.circle(surf, color, P, r, width=2)
 
+def render_shot(color, r):
+    surf = pygame.Surface((2 * r + 1, 2 * r + 1), pygame.SRCALPHA)
+    pygame.draw.circle(surf, color, (r, r), r)
 
-def draw_shot(surf, color, x, y, r):
-    w, h = surf.get_size()
-    x0 = int(x * w)
-    y0 = int(y * h)
+    return surf
 
-    for dx in (-w, 0, w):
-        for dy in (-h, 0, h):
-            cx = x0 + dx
-            cy = y0 + dy
-            if -r <= cx <= w + r and -r <= cy <= h + r:
-                pygame.draw.circle(surf, color, (cx, h - cy), r)
 
+class Sprites:
+    # headings are logged with a resolution of 0.1 deg
+    HEADING_STEPS = 3600
+
+    def __init__(self, *, r_ship, r_shot):
+        self.r_ship = r_ship
+        self.r_shot = r_shot
+
+        self._ships = {}
+        self._shots = {}
+
+    def ship(self, color, heading_step):
+        key = color, heading_step
+        sprite = self._ships.get(key)
+        if sprite is None:
+            sprite = render_ship(
+                color, self.r_ship, 360.0 * heading_step / self.HEADING_STEPS
+            )
+            self._ships[key] = sprite
+
+        return sprite
+
+    def shot(self, color):
+        sprite = self._shots.get(color)
+        if sprite is None:
+            sprite = self._shots[color] = render_shot(color, self.r_shot)
+
+        return sprite
+
+
+def draw_ships(surf, sprites, colors, x, y, heading):
+    h = surf.get_height()
+    r = sprites.r_ship
+    k, cx, cy = wrapped_centers(surf, x, y, r)
+
+    n_steps = Sprites.HEADING_STEPS
+    steps = np.rint(heading[k] * (n_steps / 360.0)).astype(np.int32) % n_steps
+
+    return surf.blits(
+        [
+            (sprites.ship(colors[i], step), (P_x - r, h - P_y - r))
+            for i, step, P_x, P_y in zip(
+                k.tolist(), steps.tolist(), cx.tolist(), cy.tolist()
+            )
+        ]
+    )
 
-def blit_overlay(screen, font, items, x=12, y=12, pad=8, line_gap=4):
-    rendered = []
+
+def draw_shots(surf, sprites, colors, x, y):
+    h = surf.get_height()
+    r = sprites.r_shot
+    k, cx, cy = wrapped_centers(surf, x, y, r)
+
+    return surf.blits(
+        [
+            (sprites.shot(colors[i]), (P_x - r, h - P_y - r))
+            for i, P_x, P_y in zip(k.tolist(), cx.tolist(), cy.tolist())
+        ]
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def render_text(font, text, color):
+    return font.render(text, True, color)
+
+
+@functools.lru_cache(maxsize=16)
+def layout_overlay(font, items, pad, line_gap):
+    lines = []
 
     max_width = 0
     total_height = 0
 
     for text, color in items:
-        surf = font.render(text, True, color)
-        rendered.append(surf)
+        surf = render_text(font, text, color)
+        lines.append((surf, total_height))
         if surf.get_width() > max_width:
             max_width = surf.get_width()
 
         total_height += surf.get_height() + line_gap
 
-    if rendered:
+    if lines:
         total_height -= line_gap
 
     bkg = pygame.Surface((max_width + 2 * pad, total_height + 2 * pad), pygame.SRCALPHA)
     bkg.fill((0, 0, 0, 160))
-    screen.blit(bkg, (x, y))
 
-    cy = y + pad
-    for surf in rendered:
-        screen.blit(surf, (x + pad, cy))
-        cy += surf.get_height() + line_gap
+    return bkg, lines
+
+
+def blit_overlay(screen, font, items, x=12, y=12, pad=8, line_gap=4):
+    # the text is blitted separately (not pre-composed onto the translucent
+    # background) to keep the alpha blending with the screen unchanged
+    bkg, lines = layout_overlay(font, tuple(items), pad, line_gap)
+    rect = screen.blit(bkg, (x, y))
+    screen.blits(
+        [(surf, (x + pad, y + pad + dy)) for surf, dy in lines], doreturn=False
+    )
+
+    return rect
+
+
+def stack_history(log):
+    ships = dict(team=[], x=[], y=[], heading=[], alive=[])
+    shots = dict(team=[], x=[], y=[], lifetime=[])
+    for i, team in enumerate(log):
+        for ship in team["ships"].values():
+            ships["team"].append(i)
+            for key in ("x", "y", "heading", "alive"):
+                ships[key].append(ship[key])
+
+        for shot in team["shots"].values():
+            shots["team"].append(i)
+            for key in ("x", "y", "lifetime"):
+                shots[key].append(shot[key])
+
+    dtypes = dict(
+        team=np.int32,
+        x=np.float32,
+        y=np.float32,
+        heading=np.float32,
+        alive=np.uint8,
+        lifetime=np.int32,
+    )
+
+    # per-tick channels are stored as (ticks, entities) such that each frame
+    # only touches one contiguous row
+    def stack(key, values):
+        a = np.asarray(values, dtype=dtypes[key])
+        return a if key == "team" else np.ascontiguousarray(a.T)
+
+    ships = {key: stack(key, values) for key, values in ships.items()}
+    shots = {key: stack(key, values) for key, values in shots.items()}
+    scores = np.ascontiguousarray(
+        np.asarray([team["scores"] for team in log], dtype=np.int32).T
+    )
+
+    return ships, shots, scores
 
 
 def main():
@@ -92,10 +227,10 @@ def main():
     )
     args = parser.parse_args()
 
-    data = json.loads(args.logfile.read_text())
-    log = data["history"]
+    data = orjson.loads(args.logfile.read_bytes())
+    ships, shots, scores = stack_history(data.pop("history"))
 
-    n_teams = len(log)
+    n_teams = scores.shape[1]
     team_names = (
         data["teams"] if "teams" in data else [f"Team {i + 1}" for i in range(n_teams)]
     )
@@ -112,6 +247,9 @@ def main():
         (200, 200, 200),  # gray
     ][:n_teams]
 
+    ship_colors = [team_colors[i % len(team_colors)] for i in ships["team"]]
+    shot_colors = [team_colors[i % len(team_colors)] for i in shots["team"]]
+
     ticks = int(data["ticks"])
     max_tick = max(0, ticks - 1)
     ship_hit_radius = float(data["ship_hit_radius"])
@@ -125,8 +263,17 @@ def main():
 
         font = pygame.font.Font(None, 22)
 
-        r_ship = max(2, int(ship_hit_radius * min(width, height)))
-        r_shot = 5
+        sprites = Sprites(
+            r_ship=max(2, int(ship_hit_radius * min(width, height))),
+            r_shot=5,
+        )
+
+        background = (15, 15, 18)
+        screen.fill(background)
+
+        # screen areas painted in the last frame, to be repainted in the next
+        dirty = [screen.get_rect()]
+        last_tick = None
 
         t = 0.0
         running = True
@@ -144,6 +291,10 @@ def main():
                         t = float(min(max_tick, t + 1))
                     elif event.key == pygame.K_DOWN:
                         t = float(max(0, t - 1))
+                elif event.type == pygame.WINDOWEXPOSED:
+                    screen.fill(background)
+                    dirty.append(screen.get_rect())
+                    last_tick = None
 
             keys = pygame.key.get_pressed()
             speed = 50 if keys[pygame.K_f] else 10
@@ -155,32 +306,34 @@ def main():
             t = float(max(0, min(max_tick, t)))
             tick = int(t)
 
+            if tick == last_tick:
+                continue
+            last_tick = tick
+
             pygame.display.set_caption(
                 f"Scubywasm replay {args.logfile} | Tick: {tick + 1}/{max_tick + 1}"
             )
-            screen.fill((15, 15, 18))
-
-            for i, team in enumerate(log):
-                for shot in team["shots"].values():
-                    if shot["lifetime"][tick] > 0:
-                        draw_shot(
-                            screen,
-                            team_colors[i % len(team_colors)],
-                            shot["x"][tick],
-                            shot["y"][tick],
-                            r_shot,
-                        )
-
-                for ship in team["ships"].values():
-                    if ship["alive"][tick]:
-                        draw_ship(
-                            screen,
-                            team_colors[i % len(team_colors)],
-                            ship["x"][tick],
-                            ship["y"][tick],
-                            r_ship,
-                            ship["heading"][tick],
-                        )
+            for rect in dirty:
+                screen.fill(background, rect)
+
+            active = np.flatnonzero(shots["lifetime"][tick] > 0)
+            rects = draw_shots(
+                screen,
+                sprites,
+                [shot_colors[k] for k in active],
+                shots["x"][tick, active],
+                shots["y"][tick, active],
+            )
+
+            alive = np.flatnonzero(ships["alive"][tick])
+            rects += draw_ships(
+                screen,
+                sprites,
+                [ship_colors[k] for k in alive],
+                ships["x"][tick, alive],
+                ships["y"][tick, alive],
+                ships["heading"][tick, alive],
+            )
 
             text_color = (235, 235, 235)
             items = [
@@ -192,12 +345,13 @@ def main():
                 ("SCORES:", text_color),
             ]
 
-            for name, color, history in zip(team_names, team_colors, log):
-                items.append((f"  {name}: {history['scores'][tick]:+d}", color))
+            for name, color, score in zip(team_names, team_colors, scores[tick]):
+                items.append((f"  {name}: {int(score):+d}", color))
 
-            blit_overlay(screen, font, items)
+            rects.append(blit_overlay(screen, font, items))
 
-            pygame.display.flip()
+            pygame.display.update(dirty + rects)
+            dirty = rects
     finally:
         pygame.quit()
 
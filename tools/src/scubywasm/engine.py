@@ -1,8 +1,12 @@
 import dataclasses
+import struct
 
 from .common import Config, Pose
 from .wasmmodule import WASMModule
 
+_POSE_STRUCT = struct.Struct("<fff")
+_CONFIG_STRUCT = struct.Struct("<ffffi")
+
 
 class Engine:
     def __init__(
@@ -28,7 +32,7 @@ class Engine:
         ]
         if engine_cfg is None:
             self._module.set_default_config(cfg_ptr)
-            cfg_values = self._module.read_struct("<ffffi", cfg_ptr)
+            cfg_values = self._module.read_struct(_CONFIG_STRUCT, cfg_ptr)
             self._cfg = Config(
                 **{key: value for key, value in zip(cfg_keys, cfg_values)}
             )
@@ -37,7 +41,7 @@ class Engine:
 
             cfg_as_dict = dataclasses.asdict(engine_cfg)
             self._module.write_struct(
-                "<ffffi", cfg_ptr, *[cfg_as_dict[key] for key in cfg_keys]
+                _CONFIG_STRUCT, cfg_ptr, *[cfg_as_dict[key] for key in cfg_keys]
             )
 
         return self._module.create_context(cfg_ptr)
@@ -47,7 +51,7 @@ class Engine:
         return self._cfg
 
     def add_agent(self, pose):
-        self._module.write_struct("<fff", self._pose_ptr, pose.x, pose.y, pose.heading)
+        self._module.write_struct(_POSE_STRUCT, self._pose_ptr, *pose)
         return self._module.add_agent(self._ctx, self._pose_ptr)
 
     def set_action(self, agent_id, action):
@@ -58,13 +62,12 @@ class Engine:
 
     def get_ship_pose(self, agent_id):
         self._module.get_ship_pose(self._ctx, agent_id, self._pose_ptr)
-        x, y, heading = self._module.read_struct("<fff", self._pose_ptr)
-        return Pose(x=x, y=y, heading=heading)
+        return Pose._make(self._module.read_struct(_POSE_STRUCT, self._pose_ptr))
 
     def get_shot_pose(self, agent_id):
         lifetime = self._module.get_shot_pose(self._ctx, agent_id, self._pose_ptr)
-        x, y, heading = self._module.read_struct("<fff", self._pose_ptr)
-        return Pose(x=x, y=y, heading=heading), lifetime
+        pose = Pose._make(self._module.read_struct(_POSE_STRUCT, self._pose_ptr))
+        return pose, lifetime
 
     def is_alive(self, agent_id):
         return self._module.is_alive(self._ctx, agent_id) == 1
@@ -1,19 +1,53 @@
 import argparse
-import json
+import concurrent.futures as cf
 import logging
 import math
 import pathlib
 import random
 import sys
 
+import numpy as np
 import wasmtime
 
 from .agent import Agent
-from .common import Pose
+from .common import Pose, serialize_log
 from .engine import Engine
+from .wasmmodule import ModuleCache
 
 logger = logging.getLogger(__name__)
 
+# poses are logged in fixed point with a resolution of 1e-4 (x, y) and 0.1 deg;
+# they are wrapped to the unit torus and [0, 360) deg before encoding, so any
+# pose (e.g. unwrapped initial poses) fits the uint16 log channels
+_POSITION_SCALE = 10_000
+_HEADING_SCALE = 10
+_HEADING_RANGE = 360 * _HEADING_SCALE
+
+
+# log channels are preallocated for max_ticks (or this many ticks if unknown)
+# and doubled in size whenever they run full
+_LOG_CAPACITY = 1_024
+
+
+def _from_fixed_point(values, scale):
+    return (values / scale).tolist()
+
+
+def _grow(channel):
+    return np.concatenate((channel, np.empty_like(channel)))
+
+
+# shared by all games of the process unless a module_cache is passed explicitly
+_MODULE_CACHE = ModuleCache()
+
+
+def _module(module_cache, wasm, *, consume_fuel=False):
+    # wasm is either the raw bytes or a module precompiled by module_cache
+    if isinstance(wasm, wasmtime.Module):
+        return wasm
+
+    return module_cache.get(wasm, consume_fuel=consume_fuel)
+
 
 class Game:
     def __init__(
@@ -27,18 +61,36 @@ class Game:
         engine_cfg=None,
         agent_fuel_limit=None,
         agent_memory_limit=None,
+        agent_decision_period=1,
+        max_ticks=None,
+        module_cache=None,
         default_agent_factory=Agent,
         agent_factory_overrides=None,
     ):
+        if agent_decision_period < 1:
+            raise ValueError(
+                f"Invalid agent decision period ({agent_decision_period=}). "
+                "Must be >= 1."
+            )
+        if not agent_wasms:
+            raise ValueError("Invalid number of agents (0). Must be >= 1.")
+
         self.ticks = 0
         self._agent_fuel_limit = agent_fuel_limit
+        self._agent_decision_period = agent_decision_period
+        self._record_fuel = agent_fuel_limit is not None
 
         init_fuel_level = None
         if agent_fuel_limit is not None:
             init_fuel_level = 100 * agent_fuel_limit  # wild guess
 
+        if module_cache is None:
+            module_cache = _MODULE_CACHE
+
         self._engine = Engine(
-            engine_wasm, store=wasmtime.Store(), engine_cfg=engine_cfg
+            _module(module_cache, engine_wasm),
+            store=wasmtime.Store(module_cache.engine()),
+            engine_cfg=engine_cfg,
         )
 
         rng = random.Random(seed)
@@ -49,11 +101,10 @@ class Game:
 
         agents = []
         for i, agent_wasm in enumerate(agent_wasms):
-            cfg = wasmtime.Config()
-            cfg.consume_fuel = agent_fuel_limit is not None
-            cfg.wasm_exceptions = True
+            consume_fuel = agent_fuel_limit is not None
+            agent_module = _module(module_cache, agent_wasm, consume_fuel=consume_fuel)
 
-            store = wasmtime.Store(wasmtime.Engine(cfg))
+            store = wasmtime.Store(module_cache.engine(consume_fuel=consume_fuel))
             store.set_limits(
                 memory_size=agent_memory_limit or -1,
                 memories=1,
@@ -65,7 +116,7 @@ class Game:
             agent_factory = overrides.get(i, default_agent_factory)
             agents.append(
                 agent_factory(
-                    agent_wasm,
+                    agent_module,
                     store=store,
                     n_agents_total=n * m,
                     agent_multiplicity=m,
@@ -83,101 +134,228 @@ class Game:
                 )
         else:
             grid_size = math.ceil(math.sqrt(n * m))
-            grid_spacing = 1.0 / grid_size
-            init_poses = [
-                Pose(
-                    x=((i + rng.uniform(0.4, 0.6)) * grid_spacing),
-                    y=((j + rng.uniform(0.4, 0.6)) * grid_spacing),
-                    heading=360 * rng.random(),
-                )
-                for i in range(grid_size)
-                for j in range(grid_size)
-            ]
-            rng.shuffle(init_poses)
-            init_poses = init_poses[: n * m]
+            grid_rng = np.random.default_rng(rng.randint(1, 1 << 32))
+
+            # one jittered pose per grid cell, of which a random subset is used
+            cell = np.arange(grid_size)
+            i, j = np.meshgrid(cell, cell, indexing="ij")
+            x = (i + grid_rng.uniform(0.4, 0.6, i.shape)) / grid_size
+            y = (j + grid_rng.uniform(0.4, 0.6, j.shape)) / grid_size
+            heading = 360 * grid_rng.random(i.shape)
+
+            chosen = grid_rng.permutation(grid_size * grid_size)[: n * m]
+            init_poses = np.stack([x.ravel(), y.ravel(), heading.ravel()], axis=1)
+            init_poses = [Pose._make(pose) for pose in init_poses[chosen].tolist()]
 
         agent_ids = [self._engine.add_agent(pose) for pose in init_poses]
         batched_agent_ids = [agent_ids[i * m : (i + 1) * m] for i in range(n)]
 
         self._teams = [(agent, ids) for agent, ids in zip(agents, batched_agent_ids)]
+
+        # every agent lives in its own store, and wasmtime releases the GIL while
+        # executing WASM code, so the agents can be run concurrently
+        self._executor = cf.ThreadPoolExecutor(
+            max_workers=len(agents), thread_name_prefix="scubywasm-agent"
+        )
+
+        # the actions of the last decision, held until the agents are asked again
+        self._actions = [[None] * len(ids) for ids in batched_agent_ids]
+        n_slots = max_ticks or _LOG_CAPACITY
         self._log = [
             {
                 "ships": {
-                    agent_id: dict(x=[], y=[], heading=[], alive=[])
+                    agent_id: dict(
+                        x=np.empty(n_slots, dtype=np.uint16),
+                        y=np.empty(n_slots, dtype=np.uint16),
+                        heading=np.empty(n_slots, dtype=np.uint16),
+                        alive=np.empty(n_slots, dtype=np.bool_),
+                    )
                     for agent_id in batch
                 },
                 "shots": {
-                    agent_id: dict(x=[], y=[], lifetime=[]) for agent_id in batch
+                    agent_id: dict(
+                        x=np.empty(n_slots, dtype=np.uint16),
+                        y=np.empty(n_slots, dtype=np.uint16),
+                        lifetime=np.empty(n_slots, dtype=np.int32),
+                    )
+                    for agent_id in batch
                 },
                 "actions": {agent_id: [] for agent_id in batch},
-                "scores": [],
-                "fuel": [],
+                "scores": np.empty(n_slots, dtype=np.int64),
             }
             for batch in batched_agent_ids
         ]
 
+        # without fuel metering, the fuel levels would all be None
+        if self._record_fuel:
+            for team in self._log:
+                team["fuel"] = []
+
+    def close(self):
+        # releases the agent threads; a game cannot be played after closing it
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     @property
     def config(self):
         return self._engine.config
 
     @property
     def log(self):
+        n = self.ticks
+        history = [
+            {
+                "ships": {
+                    agent_id: dict(
+                        x=_from_fixed_point(ship["x"][:n], _POSITION_SCALE),
+                        y=_from_fixed_point(ship["y"][:n], _POSITION_SCALE),
+                        heading=_from_fixed_point(ship["heading"][:n], _HEADING_SCALE),
+                        alive=ship["alive"][:n].tolist(),
+                    )
+                    for agent_id, ship in team["ships"].items()
+                },
+                "shots": {
+                    agent_id: dict(
+                        x=_from_fixed_point(shot["x"][:n], _POSITION_SCALE),
+                        y=_from_fixed_point(shot["y"][:n], _POSITION_SCALE),
+                        lifetime=shot["lifetime"][:n].tolist(),
+                    )
+                    for agent_id, shot in team["shots"].items()
+                },
+                "actions": team["actions"],
+                "scores": team["scores"][:n].tolist(),
+            }
+            for team in self._log
+        ]
+
+        if self._record_fuel:
+            for entry, team in zip(history, self._log):
+                entry["fuel"] = team["fuel"]
+
         return {
             "ticks": self.ticks,
             "ship_hit_radius": round(self._engine.config.ship_hit_radius, 3),
-            "history": self._log,
+            "history": history,
         }
 
+    def _grow_log(self):
+        for team in self._log:
+            for entities in (team["ships"], team["shots"]):
+                for channels in entities.values():
+                    for key, channel in channels.items():
+                        channels[key] = _grow(channel)
+
+            team["scores"] = _grow(team["scores"])
+
+    def run(self, max_ticks):
+        # play until at most one team is left alive, or for max_ticks ticks
+        tick = self.tick
+        for _ in range(max_ticks):
+            if tick() <= 1:
+                break
+
     def tick(self, n_times=1):
-        for agent, _ in self._teams:
-            agent.refuel(level=self._agent_fuel_limit)
-            agent.clear_world_state()
+        engine = self._engine
+        record_fuel = self._record_fuel
+
+        n_teams_alive = 0
+        for _ in range(n_times):
+            snapshot, n_teams_alive = self._record_state()
+            if self.ticks % self._agent_decision_period == 0:
+                self._actions = self._decide(snapshot)
+
+            for i, ((agent, agent_ids), actions) in enumerate(
+                zip(self._teams, self._actions)
+            ):
+                log = self._log[i]
+                for agent_id, action in zip(agent_ids, actions):
+                    log["actions"][agent_id].append(action)
+                    engine.set_action(agent_id, action or 0)
+
+                if record_fuel:
+                    log["fuel"].append(agent.fuel_level)
+
+            engine.tick(1)
+            self.ticks += 1
 
+        return n_teams_alive
+
+    def _record_state(self):
+        # read and log the full world state from the engine, once per tick
+        engine = self._engine
+
+        t = self.ticks
+        if t == len(self._log[0]["scores"]):
+            self._grow_log()
+
+        snapshot = []
         team_alive = [False] * len(self._teams)
         for i, (_, agent_ids) in enumerate(self._teams):
+            ships = self._log[i]["ships"]
+            shots = self._log[i]["shots"]
+
             acc_score = 0
             for agent_id in agent_ids:
-                is_alive = self._engine.is_alive(agent_id)
+                is_alive = engine.is_alive(agent_id)
 
-                ship_pose = self._engine.get_ship_pose(agent_id)
+                ship_pose = engine.get_ship_pose(agent_id)
                 team_alive[i] |= is_alive
 
-                ship = self._log[i]["ships"][agent_id]
-                ship["x"].append(round(ship_pose.x, 4))
-                ship["y"].append(round(ship_pose.y, 4))
-                ship["heading"].append(round(ship_pose.heading, 1))
-                ship["alive"].append(is_alive)
+                ship = ships[agent_id]
+                ship["x"][t] = round(ship_pose.x * _POSITION_SCALE) % _POSITION_SCALE
+                ship["y"][t] = round(ship_pose.y * _POSITION_SCALE) % _POSITION_SCALE
+                ship["heading"][t] = (
+                    round(ship_pose.heading * _HEADING_SCALE) % _HEADING_RANGE
+                )
+                ship["alive"][t] = is_alive
 
-                shot_pose, lifetime = self._engine.get_shot_pose(agent_id)
-                shot = self._log[i]["shots"][agent_id]
-                shot["x"].append(round(shot_pose.x, 4))
-                shot["y"].append(round(shot_pose.y, 4))
-                shot["lifetime"].append(lifetime)
+                shot_pose, lifetime = engine.get_shot_pose(agent_id)
+                shot = shots[agent_id]
+                shot["x"][t] = round(shot_pose.x * _POSITION_SCALE) % _POSITION_SCALE
+                shot["y"][t] = round(shot_pose.y * _POSITION_SCALE) % _POSITION_SCALE
+                shot["lifetime"][t] = lifetime
 
-                score = self._engine.get_score(agent_id)
+                score = engine.get_score(agent_id)
                 acc_score += score
 
-                for other, _ in self._teams:
-                    other.update_ship(agent_id, is_alive=is_alive, pose=ship_pose)
-                    other.update_shot(agent_id, lifetime=lifetime, pose=shot_pose)
-                    other.update_score(agent_id, score=score)
+                snapshot.append(
+                    (agent_id, is_alive, ship_pose, lifetime, shot_pose, score)
+                )
 
-            self._log[i]["scores"].append(acc_score)
+            self._log[i]["scores"][t] = acc_score
 
-        for i, (agent, agent_ids) in enumerate(self._teams):
-            for agent_id in agent_ids:
-                action = agent.make_action(agent_id, self.ticks)
-                self._log[i]["actions"][agent_id].append(action)
-                self._engine.set_action(agent_id, action or 0)
+        return snapshot, sum(team_alive)
 
-        for i, (agent, _) in enumerate(self._teams):
-            self._log[i]["fuel"].append(agent.fuel_level)
+    def _decide(self, snapshot):
+        # broadcast the frozen snapshot to every agent and collect the actions; no
+        # engine calls are interleaved here (note that wasmtime-py passes
+        # exceptions of host functions through a process-global slot, so host
+        # functions called by the agents, i.e. debug_log, must never raise)
+        def step(team):
+            agent, agent_ids = team
 
-        n_teams_alive = sum(team_alive)
-        self._engine.tick(n_times)
-        self.ticks += n_times
+            agent.refuel(level=self._agent_fuel_limit)
+            agent.clear_world_state()
 
-        return n_teams_alive
+            update_entity = agent.update_entity
+            for agent_id, is_alive, ship_pose, lifetime, shot_pose, score in snapshot:
+                update_entity(
+                    agent_id,
+                    is_alive=is_alive,
+                    ship_pose=ship_pose,
+                    lifetime=lifetime,
+                    shot_pose=shot_pose,
+                    score=score,
+                )
+
+            return [agent.make_action(agent_id, self.ticks) for agent_id in agent_ids]
+
+        return list(self._executor.map(step, self._teams))
 
 
 def main():
@@ -244,6 +422,16 @@ def main():
         metavar="T",
         help="maximum number of ticks to simulate",
     )
+    parser.add_argument(
+        "--agent_decision_period",
+        default=1,
+        type=int,
+        metavar="K",
+        help=(
+            "ask the agents for new actions only every K ticks and repeat their last "
+            "action in between. (Default: 1)"
+        ),
+    )
     parser.add_argument(
         "-o",
         type=pathlib.Path,
@@ -288,6 +476,11 @@ def main():
             f"--fuel_limit must be (much) larger than 100 (got {args.fuel_limit})"
         )
 
+    if args.agent_decision_period < 1:
+        parser.error(
+            f"--agent_decision_period must be >= 1 (got {args.agent_decision_period})"
+        )
+
     memory_limit = args.memory_limit
     if memory_limit <= 0:
         memory_limit = None
@@ -299,27 +492,25 @@ def main():
 
     engine_wasm = args.engine_wasmfile.read_bytes()
     agent_wasms = [file_name.read_bytes() for file_name in args.agent_wasmfile]
-    game = Game(
+    with Game(
         engine_wasm,
         agent_wasms,
         seed=args.seed,
         agent_multiplicity=args.multiplicity,
         agent_fuel_limit=args.fuel_limit,
         agent_memory_limit=memory_limit,
-    )
-
-    for _ in range(max_ticks):
-        n_teams_alive = game.tick()
-        if n_teams_alive <= 1:
-            break
+        agent_decision_period=args.agent_decision_period,
+        max_ticks=max_ticks,
+    ) as game:
+        game.run(max_ticks)
 
     if args.file_name is None:
-        print(json.dumps(game.log))
+        sys.stdout.flush()
+        sys.stdout.buffer.write(serialize_log(game.log))
+        sys.stdout.buffer.flush()
     else:
         args.file_name.parent.mkdir(parents=True, exist_ok=True)
-        with args.file_name.open("w") as f:
-            json.dump(game.log, f)
-            f.write("\n")
+        args.file_name.write_bytes(serialize_log(game.log))
 
     return 0
 
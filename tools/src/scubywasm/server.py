@@ -1,77 +1,113 @@
 import argparse
 import concurrent.futures as cf
-import json
+import functools
+import multiprocessing
+import os
 import pathlib
 import random
 import re
 import signal
 
+from .common import serialize_log
 from .game import Game
 
+_LOG_PATTERN = re.compile(r"^scubywasm-log_(\d+)\.json$")
+_AGENT_PATTERN = re.compile(r"^agent-v(\d+)\.wasm$")
 
-class Logger:
-    def __init__(self, log_dir, *, verbose):
-        self._verbose = verbose
 
+class Logger:
+    def __init__(self, log_dir):
         self._log_dir = log_dir
         log_dir.mkdir(parents=True, exist_ok=True)
 
-        pattern = re.compile(r"^scubywasm-log_(\d+)\.json$")
-        logs = [p for p in log_dir.glob("*.json") if pattern.match(p.name)]
-        largest = max(
-            logs, key=lambda p: int(pattern.match(p.name).group(1)), default=None
-        )
-        self._idx = (
-            0 if largest is None else int(pattern.match(largest.name).group(1)) + 1
-        )
+        with os.scandir(log_dir) as entries:
+            largest = max(
+                (
+                    int(m.group(1))
+                    for entry in entries
+                    if (m := _LOG_PATTERN.match(entry.name))
+                ),
+                default=-1,
+            )
+
+        # shared with the worker processes, which write their logs themselves
+        self._idx = multiprocessing.Value("i", largest + 1)
 
     def save_log(self, log):
-        log_file = self._log_dir / f"scubywasm-log_{self._idx}.json"
-        with log_file.open("w") as f:
-            json.dump(log, f)
-            f.write("\n")
+        with self._idx.get_lock():
+            idx = self._idx.value
+            self._idx.value += 1
+
+        log_file = self._log_dir / f"scubywasm-log_{idx}.json"
+        log_file.write_bytes(serialize_log(log))
+
+        return log_file
+
+
+# per worker process state, set up by _init_worker()
+_engine_wasm = None
+_agents_dir = None
+_logger = None
+
+
+def _init_worker(engine_wasmfile, agents_dir, logger):
+    global _engine_wasm, _agents_dir, _logger
 
-        self._idx += 1
+    _ignore_sigint()
 
-        if self._verbose:
-            print(f"Saved game log to {log_file!s}")
+    _engine_wasm = engine_wasmfile.read_bytes()
+    _agents_dir = agents_dir
+    _logger = logger
+
+
+@functools.lru_cache(maxsize=64)
+def _read_agent_wasm(path, version):
+    # agent-v<version>.wasm files are not expected to change once published;
+    # bounded, such that long-running workers drop outdated versions eventually
+    return path.read_bytes()
 
 
 def _run_game(
-    *, engine_wasm, agents_dir, agent_multiplicity, seed, max_ticks, agent_fuel_limit
+    *, agent_multiplicity, seed, max_ticks, agent_fuel_limit, agent_decision_period
 ):
     agent_wasmfiles = []
-    pattern = re.compile(r"^agent-v(\d+)\.wasm$")
-    for d in agents_dir.iterdir():
+    for d in _agents_dir.iterdir():
         if d.is_dir():
             matches = []
             for p in d.glob("*.wasm"):
-                m = pattern.match(p.name)
+                m = _AGENT_PATTERN.match(p.name)
                 if m:
                     matches.append((int(m.group(1)), p))
 
             if matches:
-                agent_wasmfiles.append(max(matches)[1])
+                agent_wasmfiles.append(max(matches))
 
-    agent_wasmfiles.sort(key=lambda p: p.parent.name)
+    agent_wasmfiles.sort(key=lambda item: item[1].parent.name)
     if not agent_wasmfiles:
         return dict()
 
-    agent_wasms = [file_name.read_bytes() for file_name in agent_wasmfiles]
-    game = Game(
-        engine_wasm, agent_wasms, seed=seed, agent_multiplicity=agent_multiplicity
-    )
+    agent_wasms = [
+        _read_agent_wasm(file_name, version) for version, file_name in agent_wasmfiles
+    ]
+    with Game(
+        _engine_wasm,
+        agent_wasms,
+        seed=seed,
+        agent_multiplicity=agent_multiplicity,
+        agent_decision_period=agent_decision_period,
+        max_ticks=max_ticks,
+    ) as game:
+        game.run(max_ticks)
 
-    for _ in range(max_ticks):
-        n_teams_alive = game.tick()
-        if n_teams_alive <= 1:
-            break
+    log = game.log
+    final_scores = [team["scores"][-1] for team in log["history"]]
+    teams = [f"{file.parent.name}/{file.stem}" for _, file in agent_wasmfiles]
 
-    log = game.log["history"]
-    final_scores = [team["scores"][-1] for team in log]
-    teams = [f"{file.parent.name}/{file.stem}" for file in agent_wasmfiles]
+    # the log is written here, such that only a small summary needs to be sent
+    # back to the main process
+    log_file = _logger.save_log(dict(teams=teams, final_scores=final_scores) | log)
 
-    return dict(teams=teams, final_scores=final_scores) | game.log
+    return dict(teams=teams, final_scores=final_scores, log_file=log_file)
 
 
 def _ignore_sigint():
@@ -165,6 +201,16 @@ def main():
         metavar="FUEL",
         help="optional fuel limit for agent calls; unset disables fuel metering",
     )
+    parser.add_argument(
+        "--agent_decision_period",
+        default=1,
+        type=int,
+        metavar="K",
+        help=(
+            "ask the agents for new actions only every K ticks and repeat their last "
+            "action in between (default: 1)"
+        ),
+    )
     parser.add_argument(
         "--log_dir",
         default=log_dir,
@@ -199,17 +245,21 @@ def main():
     if args.max_ticks < 1:
         parser.error(f"--max_ticks must be >= 1 (got {args.max_ticks})")
 
+    if args.agent_decision_period < 1:
+        parser.error(
+            f"--agent_decision_period must be >= 1 (got {args.agent_decision_period})"
+        )
+
     rng = random.Random(args.seed)
 
     kwargs = dict(
-        engine_wasm=args.engine_wasmfile.read_bytes(),
-        agents_dir=args.agents_dir,
         agent_multiplicity=args.multiplicity,
         max_ticks=args.max_ticks,
         agent_fuel_limit=args.fuel_limit,
+        agent_decision_period=args.agent_decision_period,
     )
 
-    logger = Logger(args.log_dir, verbose=args.verbose)
+    logger = Logger(args.log_dir)
 
     stopping = False
 
@@ -221,7 +271,9 @@ def main():
     signal.signal(signal.SIGTERM, _on_sigint)
 
     with cf.ProcessPoolExecutor(
-        max_workers=args.workers, initializer=_ignore_sigint
+        max_workers=args.workers,
+        initializer=_init_worker,
+        initargs=(args.engine_wasmfile, args.agents_dir, logger),
     ) as ex:
         futures = set()
         for _ in range(args.workers):
@@ -238,7 +290,8 @@ def main():
                 try:
                     res = future.result()
                     if res:
-                        logger.save_log(res)
+                        if args.verbose:
+                            print(f"Saved game log to {res['log_file']!s}")
                     else:
                         print("Warning: worker didn't find any agents!")
                 except Exception as e:
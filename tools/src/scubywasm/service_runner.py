@@ -1,9 +1,11 @@
 import argparse
+import collections
 import dataclasses
 import datetime
 import errno
-import inspect
-import json
+import fnmatch
+import functools
+import multiprocessing
 import os
 import pathlib
 import random
@@ -11,15 +13,159 @@ import re
 import signal
 import sys
 import tempfile
-import concurrent.futures as cf
-from time import sleep
-from .game import Game
+from time import monotonic, time_ns
+
+import orjson
+
 from .common import Config as EngineConfig
+from .common import serialize_log
+from .game import Game
+from .wasmmodule import ModuleCache, wasm_digest
 
 RESULTS_DIR = None
 ENGINE_WASM = None
+ENGINE_WASM_BYTES = None
+ENGINE_WASM_DIGEST = None
+MODULE_CACHE = None
+
+# seconds between two scans for changed agents while a scenario is running
+AGENTS_RESCAN_INTERVAL = 5.0
+
+
+def _init_worker(module_cache_dir):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # one set of wasmtime engines and compiled modules per scenario process for
+    # all of its rounds; compiled modules are persisted in a private cache dir
+    # shared by all scenarios (never in the published results dir)
+    global MODULE_CACHE, ENGINE_WASM_BYTES, ENGINE_WASM_DIGEST
+    MODULE_CACHE = ModuleCache(module_cache_dir)
+    ENGINE_WASM_BYTES = ENGINE_WASM.read_bytes()
+    ENGINE_WASM_DIGEST = wasm_digest(ENGINE_WASM_BYTES)
+
+
+def _run_scenario(scenario, stop, module_cache_dir):
+    # each scenario is pinned to its own process, which keeps the scenario state
+    # and compiled modules across rounds
+    _init_worker(module_cache_dir)
+
+    while not stop.is_set():
+        try:
+            scenario.run(stop)
+        except Exception as e:
+            print(f"Scenario '{scenario.name}' failed: {e!r}")
+            stop.wait(10)
+
+
+def _read_file(path, size):
+    # read a file whose size is (most likely) known with a single pread(), rather
+    # than going through the buffered io stack
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        data = os.pread(fd, size, 0)
+        # the final empty read confirms that nothing was appended in the meantime
+        while chunk := os.pread(fd, 1 << 16, len(data)):
+            data += chunk
+        return data
+    finally:
+        os.close(fd)
+
+
+@functools.lru_cache(maxsize=64)
+def _snapshot_agent(agent_file, dest_file, size):
+    # the copy in the result dir is never modified afterwards, so its bytes (and
+    # their digest for the module cache) can be reused for all rounds of a
+    # scenario without touching the disk or hashing them again
+    if dest_file.exists():
+        wasm = _read_file(dest_file, size)
+    else:
+        wasm = _read_file(agent_file, size)
+        dest_file.write_bytes(wasm)
+    return wasm, wasm_digest(wasm)
+
+
+_GLOB_MAGIC = re.compile(r"[*?\[]")
+
+# directories modified less than this many ns before they were listed may still
+# change without a new mtime, so their listing is not reused
+_RACY_MTIME_NS = 2_000_000_000
+
+
+class _GlobScanner:
+    # walks the directory tree for a glob pattern with os.scandir; a directory is
+    # only listed again if its mtime changed since the last scan, the matching
+    # files themselves are always reported (and stat'ed by the caller)
+    def __init__(self):
+        self._listings = {}
+
+    def scan(self, base, pattern):
+        listings = {}
+        yield from self._scan(base, pathlib.PurePath(pattern).parts, listings)
+        self._listings = listings
+
+    def _list_dir(self, path, listings):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+
+        cached = self._listings.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            listing = cached[1]
+        else:
+            try:
+                with os.scandir(path) as it:
+                    listing = [
+                        (
+                            entry.name,
+                            entry.path,
+                            entry.is_dir(),
+                            entry.is_dir(follow_symlinks=False),
+                            entry.is_file(),
+                        )
+                        for entry in it
+                    ]
+            except OSError:
+                return []
+
+        if time_ns() - mtime_ns > _RACY_MTIME_NS:
+            listings[path] = (mtime_ns, listing)
+        return listing
+
+    def _scan(self, base, parts, listings):
+        head, rest = parts[0], parts[1:]
+        if rest and not _GLOB_MAGIC.search(head):
+            yield from self._scan(os.path.join(base, head), rest, listings)
+            return
+
+        listing = self._list_dir(base, listings)
+
+        if head == "**":
+            if rest:
+                yield from self._scan(base, rest, listings)
+            for _, path, _, is_real_dir, _ in listing:
+                if is_real_dir:
+                    yield from self._scan(path, parts, listings)
+            return
+
+        for name, path, is_dir, _, is_file in listing:
+            if not fnmatch.fnmatchcase(name, head):
+                continue
+            if rest:
+                if is_dir:
+                    yield from self._scan(path, rest, listings)
+            elif is_file:
+                yield path
+
+
+# per worker process, shared by all scenarios
+_AGENT_SCANNER = _GlobScanner()
+
 
 class Logger:
+    # the log dir is only scanned once; afterwards, the logger keeps track of the
+    # logs it has written itself to prune the oldest ones
     def __init__(self, log_dir, *, max_logs, verbose):
         self._verbose = verbose
         self._max_logs = max_logs
@@ -28,13 +174,8 @@ class Logger:
 
         log_dir.mkdir(parents=True, exist_ok=True)
 
-        logs = self._get_logs()
-        largest = max(
-            logs, key=lambda item: item[0], default=None
-        )
-        self._idx = (
-            0 if largest is None else largest[0] + 1
-        )
+        self._logs = collections.deque(self._get_logs())
+        self._idx = 0 if not self._logs else self._logs[-1][0] + 1
         self._prune_logs()
 
     def _get_logs(self):
@@ -53,37 +194,32 @@ class Logger:
     def _prune_logs(self):
         if self._max_logs is None:
             return
-        logs = self._get_logs()
-        if self._max_logs <= 0:
-            for _, path in logs:
-                try:
-                    path.unlink()
-                except FileNotFoundError:
-                    pass
-            return
-        excess = len(logs) - self._max_logs
-        if excess <= 0:
-            return
-        for _, path in logs[:excess]:
-            try:
-                path.unlink()
-            except FileNotFoundError:
-                pass
+        while self._logs and len(self._logs) > max(self._max_logs, 0):
+            _, path = self._logs.popleft()
+            path.unlink(missing_ok=True)
 
     def save_log(self, log):
         log_file = self._log_dir / f"scubywasm-log_{self._idx}.json"
-        with log_file.open("w") as f:
-            json.dump(log, f)
-            f.write("\n")
+        log_file.write_bytes(serialize_log(log))
 
+        self._logs.append((self._idx, log_file))
         self._idx += 1
         self._prune_logs()
 
         if self._verbose:
             print(f"Saved game log to {log_file!s}")
 
+
 class Scenario:
-    def __init__(self, name, multiplicity=1, max_ticks=1000, fuel_limit=1000, max_rounds=100, engine_cfg=None):
+    def __init__(
+        self,
+        name,
+        multiplicity=1,
+        max_ticks=1000,
+        fuel_limit=1000,
+        max_rounds=100,
+        engine_cfg=None,
+    ):
         self.name = name
         self.multiplicity = multiplicity
         self.max_ticks = max_ticks
@@ -93,112 +229,215 @@ class Scenario:
         self.round = 0
         self.notified = False
         self.result_dir = None
+        self._logger = None
         self.engine_cfg = engine_cfg
-        
+        self._agents_signature = ()
+        self._last_scan = None
+        self._digests = {}
+
     def gather_agents(self):
         agents = {}
-        for agent_file in pathlib.Path("/").glob(AGENTS_GLOB.lstrip("/")):
+        for path in _AGENT_SCANNER.scan("/", AGENTS_GLOB.lstrip("/")):
+            agent_file = pathlib.Path(path)
             user = agent_file.parent.stem
             agent_name = agent_file.stem
             if agent_name not in agents:
-                agents[agent_name] =  (agent_file, agent_file.stat().st_mtime, agent_file.stat().st_size, user)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                digest = self._digest(agent_file, st.st_mtime_ns, st.st_size)
+                if digest is None:
+                    # unreadable, or removed in the meantime
+                    continue
+                agents[agent_name] = (
+                    agent_file,
+                    st.st_mtime_ns,
+                    st.st_size,
+                    user,
+                    digest,
+                )
+
+        # forget the digests of agents that are gone
+        files = {agent_file for agent_file, *_ in agents.values()}
+        self._digests = {
+            path: cached for path, cached in self._digests.items() if path in files
+        }
         return agents
-    
-    def need_restart(self, agents):
-        if set(agents.keys()) != set(self.agents.keys()):
-            return True
-        for agent_name, (_, mtime, size, _) in agents.items():
-            if agent_name not in self.agents:
-                return True
-            old_mtime, old_size = self.agents[agent_name][1], self.agents[agent_name][2]
-            if mtime != old_mtime or size != old_size:
-                return True
-        return False
-    
+
+    def _digest(self, agent_file, mtime_ns, size):
+        # agent files are only read and hashed again if their mtime or size
+        # changed, and not trusted if they were modified just now
+        cached = self._digests.get(agent_file)
+        if cached is not None and cached[:2] == (mtime_ns, size):
+            return cached[2]
+        try:
+            digest = wasm_digest(_read_file(agent_file, size))
+        except OSError:
+            return None
+        if time_ns() - mtime_ns > _RACY_MTIME_NS:
+            self._digests[agent_file] = (mtime_ns, size, digest)
+        return digest
+
+    @staticmethod
+    def _signature(agents):
+        # based on the file contents (the same digest that keys the module cache),
+        # such that touching an agent without changing it doesn't restart
+        return tuple(
+            sorted(
+                (name, size, digest) for name, (_, _, size, _, digest) in agents.items()
+            )
+        )
+
+    def need_restart(self, signature):
+        return signature != self._agents_signature
+
+    def _rescan_due(self):
+        return (
+            not self.agents
+            or self._last_scan is None
+            or monotonic() - self._last_scan >= AGENTS_RESCAN_INTERVAL
+        )
+
     def run_game(self):
-        agent_files = {name: (agent_file, user) for name, (agent_file, _, _, user) in self.agents.items()}
-        agents=[]
-        for agent_file, user in agent_files.values():
+        agent_files = {
+            name: (agent_file, size, user)
+            for name, (agent_file, _, size, user, _) in self.agents.items()
+        }
+        agents = []
+        agent_wasms = []
+        agent_digests = []
+        for agent_file, size, user in agent_files.values():
             dest_file = self.result_dir / f"{user}-{agent_file.stem}.wasm"
-            if not dest_file.exists():
-                dest_file.write_bytes(agent_file.read_bytes())
+            wasm, digest = _snapshot_agent(agent_file, dest_file, size)
+            agent_wasms.append(wasm)
+            agent_digests.append(digest)
             agents.append(dest_file)
-        agent_wasms = [file_name.read_bytes() for file_name in agents]
 
-        logger = Logger(self.result_dir, max_logs=self.max_rounds,verbose=False)
+        # new agents are compiled all at once after a restart, instead of one
+        # after the other while setting up the first game
+        consume_fuel = self.fuel_limit is not None
+        if self.round == 0:
+            MODULE_CACHE.precompile(
+                agent_wasms, consume_fuel=consume_fuel, digests=agent_digests
+            )
 
-        game = Game(
-            ENGINE_WASM.read_bytes(), agent_wasms, seed=random.randint(0, 2**32 - 1), agent_multiplicity=self.multiplicity, agent_fuel_limit=self.fuel_limit, engine_cfg=self.engine_cfg
-        )
+        # the modules are looked up by their known digests, such that the game
+        # does not hash the WASM bytes again
+        engine_module = MODULE_CACHE.get(ENGINE_WASM_BYTES, digest=ENGINE_WASM_DIGEST)
+        agent_modules = [
+            MODULE_CACHE.get(wasm, consume_fuel=consume_fuel, digest=digest)
+            for wasm, digest in zip(agent_wasms, agent_digests)
+        ]
 
-        for _ in range(self.max_ticks):
-            n_teams_alive = game.tick()
-            if n_teams_alive <= 1:
-                break
+        with Game(
+            engine_module,
+            agent_modules,
+            seed=random.randint(0, 2**32 - 1),
+            agent_multiplicity=self.multiplicity,
+            agent_fuel_limit=self.fuel_limit,
+            engine_cfg=self.engine_cfg,
+            max_ticks=self.max_ticks,
+            module_cache=MODULE_CACHE,
+        ) as game:
+            game.run(self.max_ticks)
 
-        log = game.log["history"]
-        final_scores = [team["scores"][-1] for team in log]
-        teams = [f"{file.stem}" for file in agents]
-        logger.save_log(dict(teams=teams, final_scores=final_scores) | game.log)
+        # game.log assembles the complete history, so it is only built once
+        log = game.log
+        teams = [file.stem for file in agents]
+        final_scores = [team["scores"][-1] for team in log["history"]]
+        self._logger.save_log(dict(teams=teams, final_scores=final_scores) | log)
+
+    def run(self, stop):
+        if not self._rescan_due():
+            self.run_game()
+            self.round += 1
+            return self
 
-    def run(self):
         agents = self.gather_agents()
+        self._last_scan = monotonic()
         if not agents or len(agents) == 0:
             self.round = 0
             self.agents = {}
+            self._agents_signature = ()
             if not self.notified:
-                print(f"Warning: no agents found for scenario '{self.name}', sleeping...")
+                print(
+                    f"Warning: no agents found for scenario '{self.name}', sleeping..."
+                )
                 self.notified = True
-            sleep(5)
+            # wait for new agents, but wake up right away when stopping
+            stop.wait(5)
             return self
-        if self.need_restart(agents) or self.result_dir is None:
+        signature = self._signature(agents)
+        if self.need_restart(signature) or self.result_dir is None:
             self.round = 0
             self.agents = agents
-            self.result_dir = RESULTS_DIR / self.name / datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f")[:-3]
+            self._agents_signature = signature
+            self.result_dir = (
+                RESULTS_DIR
+                / self.name
+                / datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f")[:-3]
+            )
             self.result_dir.mkdir(parents=True, exist_ok=True)
+            self._logger = Logger(
+                self.result_dir, max_logs=self.max_rounds, verbose=False
+            )
+
+            # only modules of agents that no longer match the agents glob at all
+            # are removed; scenarios in other processes that still play an older
+            # version of an agent have it loaded already, and switch to the
+            # current version on their next scan (at worst, a module is compiled
+            # again if such a process restarts in between)
+            MODULE_CACHE.prune(
+                {ENGINE_WASM_DIGEST} | {digest for *_, digest in agents.values()}
+            )
 
-        #elif self.round >= self.max_rounds:
+        # elif self.round >= self.max_rounds:
         #    if not self.notified:
         #        print(f"Reached max rounds for scenario '{self.name}', sleeping...")
         #        self.notified = True
         #    sleep(5)
         #    return self
-        
+
         self.notified = False
         self.run_game()
         self.round += 1
         return self
-    
-SCENARIO_KEYS = [("name", str),
-                 ("multiplicity", int), 
-                 ("max_ticks", int),
-                 ("fuel_limit", int)]
+
+
+SCENARIO_KEYS = [
+    ("name", str),
+    ("multiplicity", int),
+    ("max_ticks", int),
+    ("fuel_limit", int),
+]
+
+_SCENARIO_KEY_NAMES = frozenset(key for key, _ in SCENARIO_KEYS)
+
 
 def _validate_scenario(scenario, index):
     if not isinstance(scenario, dict):
         raise ValueError(f"scenario at index {index} must be an object")
-    missing = [key for key, _ in SCENARIO_KEYS if key not in scenario]
-    if missing:
+    if not scenario.keys() >= _SCENARIO_KEY_NAMES:
+        missing = [key for key, _ in SCENARIO_KEYS if key not in scenario]
         raise ValueError(
             f"scenario at index {index} is missing required properties: {', '.join(missing)}"
         )
-    if not isinstance(scenario["name"], str):
-        raise ValueError(f"scenario at index {index} must have string 'name'")
-    for key, expected_type in SCENARIO_KEYS[1:]:
-        value = scenario[key]
-        if not isinstance(value, expected_type):
-            raise ValueError(
-                f"scenario '{scenario['name']}' must have integer '{key}'"
-            )
+    for key, expected_type in SCENARIO_KEYS:
+        if isinstance(scenario[key], expected_type):
+            continue
+        if key == "name":
+            raise ValueError(f"scenario at index {index} must have string 'name'")
+        raise ValueError(f"scenario '{scenario['name']}' must have integer '{key}'")
+
+
+_ENGINE_CONFIG_KEYS = tuple(field.name for field in dataclasses.fields(EngineConfig))
 
-def _get_engineconfig_keys():
-    members = dict(inspect.getmembers(EngineConfig))
-    return [field.name for field in list(dict(members)['__dataclass_fields__'].values()) ]
 
 def _read_scenarios(scenario_file):
     if not os.path.exists(scenario_file):
         raise FileNotFoundError(f"scenario file {scenario_file!s} does not exist")
-    s = json.load(scenario_file.open())
+    s = orjson.loads(scenario_file.read_bytes())
     if not isinstance(s, list):
         raise ValueError("scenario file must contain a JSON array")
     scenarios = {}
@@ -211,15 +450,22 @@ def _read_scenarios(scenario_file):
             scenario["max_ticks"],
             scenario["fuel_limit"],
             scenario["max_rounds"],
-            engine_cfg=EngineConfig(**{key: scenario[key] for key in _get_engineconfig_keys()})
+            engine_cfg=EngineConfig(
+                **{key: scenario[key] for key in _ENGINE_CONFIG_KEYS}
+            ),
         )
-    
+
     return scenarios
 
+
+def _default_module_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return pathlib.Path(cache_home) / "scubywasm" / "modules"
+
+
 def main():
     sys.stdout.reconfigure(line_buffering=True)
-    
-    
+
     parser = argparse.ArgumentParser(
         prog="scubywasm-service-runner",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -234,7 +480,6 @@ def main():
             "  to be downloaded via a HTTP-server.\n\n"
             "agents\n"
             "  Agents are taken from a glob pattern specified on the commandline. In the logs, the name used is a combination of the user name and the file name\n"
-           
         ),
     )
     parser.add_argument(
@@ -271,6 +516,16 @@ def main():
             "agents is updated"
         ),
     )
+    parser.add_argument(
+        "--module_cache_dir",
+        type=pathlib.Path,
+        metavar="DIR",
+        default=_default_module_cache_dir(),
+        help=(
+            "private directory to persist compiled wasm modules in; must not be "
+            "inside RESULTS_DIR (default: %(default)s)"
+        ),
+    )
 
     args = parser.parse_args()
 
@@ -279,56 +534,52 @@ def main():
     if not args.results_dir.exists():
         args.results_dir.mkdir(parents=True)
     if not args.results_dir.exists() or not args.results_dir.is_dir():
-        raise NotADirectoryError(f"results path {args.results_dir!s} does not exist or is not a directory")
+        raise NotADirectoryError(
+            f"results path {args.results_dir!s} does not exist or is not a directory"
+        )
     try:
-        testfile = tempfile.TemporaryFile(dir = args.results_dir)
+        testfile = tempfile.TemporaryFile(dir=args.results_dir)
         testfile.close()
     except OSError as e:
-       raise OSError(f"results path {args.results_dir!s} is not writable")
-    
+        raise OSError(f"results path {args.results_dir!s} is not writable")
+
+    if args.module_cache_dir.resolve().is_relative_to(args.results_dir.resolve()):
+        raise ValueError(
+            f"module cache dir {args.module_cache_dir!s} must not be inside the "
+            "results path"
+        )
+
     if not args.engine_wasmfile.exists() or not args.engine_wasmfile.is_file():
-        raise FileNotFoundError(f"engine wasm file {args.engine_wasmfile!s} does not exist or is not a file")
-    
+        raise FileNotFoundError(
+            f"engine wasm file {args.engine_wasmfile!s} does not exist or is not a file"
+        )
+
     global RESULTS_DIR, ENGINE_WASM, AGENTS_GLOB
     RESULTS_DIR = args.results_dir
     ENGINE_WASM = args.engine_wasmfile
     AGENTS_GLOB = args.agents_glob
 
-    stopping = False
-    
-    def _ignore_sigint():
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
-        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    stop = multiprocessing.Event()
 
     def _on_sigint(signum, frame):
-        nonlocal stopping
-        stopping = True
+        stop.set()
 
     signal.signal(signal.SIGINT, _on_sigint)
     signal.signal(signal.SIGTERM, _on_sigint)
 
-    with cf.ProcessPoolExecutor(
-        max_workers=len(scenarios), initializer=_ignore_sigint
-    ) as ex:
-        futures = set()
-        for scenario in scenarios.values():
-            futures.add(ex.submit(scenario.run))
-
-        while futures:
-            done, pending = cf.wait(
-                futures,
-                return_when=cf.FIRST_COMPLETED,
-            )
+    processes = [
+        multiprocessing.Process(
+            target=_run_scenario,
+            args=(scenario, stop, args.module_cache_dir),
+            name=f"scenario-{scenario.name}",
+        )
+        for scenario in scenarios.values()
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
 
-            futures = pending
-            for future in done:
-                try:
-                    scenario = future.result()
-                except Exception as e:
-                    print(f"Worker failed: {e!r}")
-                    sleep(10)
-                if not stopping:
-                    futures.add(ex.submit(scenario.run))
 
 if __name__ == "__main__":
     main()
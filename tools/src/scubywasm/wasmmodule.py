@@ -1,20 +1,163 @@
+import concurrent.futures as cf
+import ctypes
 import functools
+import hashlib
 import logging
+import os
 import struct
+import tempfile
+import threading
+import time
 
 import wasmtime
 
-logging = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 
 def debug_log(caller, start, length):
-    mem = caller["memory"]
-    msg = (
-        mem.read(caller, start, start + length)
-        .decode("utf-8", errors="replace")
-        .strip()
-    )
-    logging.debug(msg)
+    # agents may log a lot; only touch their memory if the message is emitted
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    # must never raise: wasmtime-py hands exceptions of host functions to the
+    # trapping call through a process-global slot, so with agents running on
+    # several threads, the exception could surface in another agent's call
+    try:
+        mem = caller["memory"]
+
+        # clamped to the linear memory, just like slicing
+        start, stop, _ = slice(start, start + length).indices(mem.data_len(caller))
+        msg = b""
+        if stop > start:
+            base = ctypes.addressof(mem.data_ptr(caller).contents)
+            msg = ctypes.string_at(base + start, stop - start)
+
+        logger.debug(msg.decode("utf-8", errors="replace").strip())
+    except Exception:
+        pass
+
+
+def wasm_digest(wasm):
+    return hashlib.blake2b(wasm, digest_size=16).hexdigest()
+
+
+# temporary files of cache writes older than this many seconds were left behind
+# by a writer that crashed or got killed
+_STALE_TMP_SECONDS = 600
+
+
+@functools.lru_cache(maxsize=64)
+def _compiled(fmt):
+    return struct.Struct(fmt)
+
+
+class ModuleCache:
+    # compiled modules keyed by the WASM digest and the fuel setting, such that
+    # repeated games and teams sharing the same agent do not run the compiler
+    # again; with a cache_dir, compiled modules are also persisted across
+    # processes and restarts (cache_dir must be private, as its contents are
+    # loaded as native code)
+    def __init__(self, cache_dir=None, *, max_size=64):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._engines = {}
+        self._modules = {}
+        self._lock = threading.Lock()
+
+        if cache_dir is not None:
+            cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    def engine(self, *, consume_fuel=False):
+        engine = self._engines.get(consume_fuel)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(consume_fuel)
+                if engine is None:
+                    cfg = wasmtime.Config()
+                    cfg.consume_fuel = consume_fuel
+                    cfg.wasm_exceptions = True
+                    cfg.wasm_simd = True
+                    cfg.cranelift_opt_level = "speed"
+
+                    engine = self._engines[consume_fuel] = wasmtime.Engine(cfg)
+
+        return engine
+
+    def get(self, wasm, *, consume_fuel=False, digest=None):
+        # digest is the wasm_digest() of wasm, if the caller already knows it
+        key = digest or wasm_digest(wasm), consume_fuel
+        module = self._modules.get(key)
+        if module is None:
+            module = self._load(key, wasm)
+
+            with self._lock:
+                if len(self._modules) >= self._max_size:
+                    del self._modules[next(iter(self._modules))]
+                self._modules[key] = module
+
+        return module
+
+    def precompile(self, wasms, *, consume_fuel=False, digests=None):
+        # wasmtime releases the GIL while compiling, so uncached modules are
+        # compiled concurrently
+        if digests is None:
+            digests = [None] * len(wasms)
+
+        def get(wasm, digest):
+            return self.get(wasm, consume_fuel=consume_fuel, digest=digest)
+
+        with cf.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            list(ex.map(get, wasms, digests))
+
+    def prune(self, keep):
+        # remove the persisted modules (of any fuel setting) whose digest is not
+        # in keep, and stale temporary files; modules that are already loaded
+        # stay usable
+        if self._cache_dir is None:
+            return
+
+        for path in self._cache_dir.glob("*.cwasm"):
+            if path.stem.removesuffix("-fuel") not in keep:
+                path.unlink(missing_ok=True)
+
+        stale = time.time() - _STALE_TMP_SECONDS
+        for path in self._cache_dir.glob("*.tmp"):
+            try:
+                if path.stat().st_mtime < stale:
+                    path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass
+
+    def _load(self, key, wasm):
+        digest, consume_fuel = key
+        engine = self.engine(consume_fuel=consume_fuel)
+
+        if self._cache_dir is None:
+            return wasmtime.Module(engine, wasm)
+
+        path = self._cache_dir / f"{digest}{'-fuel' if consume_fuel else ''}.cwasm"
+        try:
+            return wasmtime.Module.deserialize_file(engine, str(path))
+        except wasmtime.WasmtimeError as e:
+            # wasmtime reports missing files like this, too; only existing files
+            # are discarded, e.g. if written by a different wasmtime version
+            if path.exists():
+                logger.info("Discarding cached module %s: %s", path, e)
+
+        module = wasmtime.Module(engine, wasm)
+
+        # never rewrite a cache file in place: other processes may be reading it,
+        # and deserialized modules keep their file mapped in memory
+        fd, tmp = tempfile.mkstemp(dir=self._cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(module.serialize())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        return module
 
 
 class WASMModule:
@@ -34,39 +177,70 @@ class WASMModule:
         )
         linker.define(store, "debug", "debug_log", dbg)
 
-        self._instance = linker.instantiate(
-            self._store,
-            wasmtime.Module(self._store.engine, wasm),
-        )
-        self._memory = self._instance.exports(self._store)["memory"]
+        # wasm is either the raw bytes or a module precompiled for store.engine
+        if not isinstance(wasm, wasmtime.Module):
+            wasm = wasmtime.Module(self._store.engine, wasm)
 
+        self._instance = linker.instantiate(self._store, wasm)
         exports = self._instance.exports(self._store)
+        self._memory = exports["memory"]
+        self._memory_view = None
+        self._memory_size = -1
+
+        # bind all exported functions up front; public names that do not clash
+        # with the attributes of this object are also set on the instance, such
+        # that calls are plain attribute lookups that never fall through to
+        # __getattr__ (exports are untrusted and must never shadow host state)
+        self._funcs = {
+            name: functools.partial(export, self._store)
+            for name, export in exports.items()
+            if isinstance(export, wasmtime.Func)
+        }
+        for name, bound in self._funcs.items():
+            if not (
+                name.startswith("_") or name in vars(self) or hasattr(type(self), name)
+            ):
+                setattr(self, name, bound)
+
         if "_initialize" in exports:
             exports["_initialize"](store)
         elif "__wasm_call_ctors" in exports:
             exports["__wasm_call_ctors"](store)
 
     def __getattr__(self, name):
-        exports = self._instance.exports(self._store)
-
+        # only reached for exports that were not set on the instance
         try:
-            export = exports[name]
+            return self.__dict__["_funcs"][name]
         except KeyError as e:
             raise AttributeError(
                 f"{type(self).__name__} has no attribute {name!r} (no such WASM export)"
             ) from e
 
-        bound = functools.partial(export, self._store)
-        setattr(self, name, bound)
-
-        return bound
-
     @property
     def store(self):
         return self._store
 
-    def read_struct(self, fmt, ptr):
-        return struct.unpack_from(fmt, self._memory.get_buffer_ptr(self._store), ptr)
+    @property
+    def memory(self):
+        # writable view of the complete linear memory; the memory only moves
+        # when it grows, so the view is rebuilt whenever its size changes
+        size = self._memory.data_len(self._store)
+        if size != self._memory_size:
+            self._memory_view = self._memory.get_buffer_ptr(self._store, size)
+            self._memory_size = size
+
+        return self._memory_view
+
+    # layout is a struct.Struct or a struct format string
+
+    def read_struct(self, layout, ptr):
+        if not isinstance(layout, struct.Struct):
+            layout = _compiled(layout)
+
+        return layout.unpack_from(self.memory, ptr)
+
+    def write_struct(self, layout, ptr, *values):
+        if not isinstance(layout, struct.Struct):
+            layout = _compiled(layout)
 
-    def write_struct(self, fmt, ptr, *values):
-        self._memory.write(self._store, struct.pack(fmt, *values), ptr)
+        layout.pack_into(self.memory, ptr, *values)